@@ -2,27 +2,91 @@
 
 """
 This program takes in a multiple sequence aignment (MSA) file and a reference genome name as input and cleans the region between the loci based on the specified reference genome. 
-Ensure that the version of Python used is 2+
+Ensure that the version of Python used is 3+
 
 Example command: clean_MSA_loci.py FcC_supermatrix.fas 'BMORI'
 The command above will result in a cleaned file named 'cleaned_loci_FcC_supermatrix.fas'
 
 To specify name of output file: clean_MSA_loci.py FcC_supermatrix.fas 'BMORI' --out desired_name.fas
+To write each sequence on a single line instead of 80 characters per line: clean_MSA_loci.py FcC_supermatrix.fas 'BMORI' --width 0
+To clean the sequences using 4 processes: clean_MSA_loci.py FcC_supermatrix.fas 'BMORI' --threads 4
 
 Nhi Vo    01 August 2022
 """
 
 import argparse
+import mmap
 import os
+import re
+import tempfile
+from array import array
+from itertools import islice
+from multiprocessing import Pool
 
-# COMMAND LINE ARGUMENTS:
-parser = argparse.ArgumentParser()
-# required parameters/inputs:
-parser.add_argument("file", help="path to fasta file containing the multiple sequence alignment to be cleaned.")
-parser.add_argument("ref", help="name of the reference genome in the MSA fasta file (does not have to be the whole name, just needs to be unique enough). Other sequences will be trimmed based on the gap of this sequence. ex: 'BMORI'")
-# optional parameters/inputs:
-parser.add_argument("--out", help="path/name of file output. False = output would be in current directory.") 
-args = parser.parse_args()
+GAP_PATTERN = re.compile(rb'-+')  # a run of gaps in the reference genome
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MB buffer for writing the output file 
+POOL_CHUNKSIZE = 32  # number of sequences sent to a worker process at a time 
+MAX_UNROLLED_RANGES = 10000  # above this many flanking regions, the cleaner loops instead of being generated 
+
+def make_cleaner(flank_ranges):
+    """
+    Build the function that overwrites every flanking region of a sequence with '-'. The same ranges are applied 
+    to every sequence, so the function is generated once with the coordinates written out as constants, 
+    ex: seq[20:26] = b'-'*6 
+    
+    param mode: list of (start, end) tuples of flanking regions
+    return: function taking a bytearray, overwriting it in place and returning it
+    """
+    if len(flank_ranges) > MAX_UNROLLED_RANGES:
+        # a very long generated function is slow to compile, fall back to a loop 
+        def cleaner(seq):
+            for start, end in flank_ranges:
+                seq[start:end+1] = b'-'*(end-start+1)
+            return seq
+        return cleaner
+    
+    source = ['def cleaner(seq):']
+    for start, end in flank_ranges:
+        source.append("    seq[%d:%d] = b'-'*%d" % (start, end+1, end-start+1))
+    source.append('    return seq')
+    namespace = {}
+    exec('\n'.join(source), namespace)
+    return namespace['cleaner']
+
+def clean_seq(value, cleaner):
+    """
+    Replace every flanking region of a single aligned sequence with '-'
+    
+    param mode: bytes, aligned sequence; function from make_cleaner()
+    return: bytearray, cleaned sequence
+    """
+    seq = bytearray(value)  # mutable copy, each range is overwritten in place
+    return cleaner(seq)
+
+def wrap_seq(value, width):
+    """
+    Split a sequence into lines of fixed width, as in a standard fasta file
+    
+    param mode: bytes, sequence; int, number of characters per line (0 = whole sequence on one line)
+    return: bytes, sequence with line breaks every width characters
+    """
+    if not width:
+        return value
+    return b'\n'.join(value[i:i+width] for i in range(0, len(value), width))
+
+def _init_worker(flank_ranges):
+    """
+    Build the cleaner in a worker process, so the flanking regions are only sent once per worker instead of once 
+    per sequence (generated functions can't be sent between processes)
+    """
+    global _worker_cleaner
+    _worker_cleaner = make_cleaner(flank_ranges)
+
+def _clean_one(value):
+    """
+    Clean one sequence inside a worker process
+    """
+    return clean_seq(value, _worker_cleaner)
 
 class Sequence:
     def __init__(self, filename=''):
@@ -32,157 +96,175 @@ class Sequence:
         param mode: string, path of file to be edited
         """
         self.filename = filename  # name of file to be read 
-        self.seqdict = {}  # dictionary of sequence names (dict keys) and genomic sequences (dict values) 
+        self.header_offsets = []  # offset of every sequence name in the file, followed by the end of the file 
         
         if filename:
-            self.open_file('r') 
+            self.open_file() 
             
-    def open_file(self, mode):
+    def open_file(self):
         """
-        Opens file contained in self.filename and sets the filehandle as self.file 
+        Maps file contained in self.filename into memory (read only) and sets the mapped bytes as self.file 
         If the file can't be opened, exit status will equal 1
-
-        param mode: string, mode for opening file, usually 'r' or 'w'
-        return: filehandle of opened file
         """
         try:
-            self.file = open(self.filename, mode)
+            with open(self.filename, 'rb') as f:
+                self.file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped, there is nothing to read 
+            self.file = b''
         except OSError:
             print('Error opening file named' + self.filename)
             # exit with status = 1
             exit(1)
             
-    def next_line(self):
+    def read_file(self, ref_name): 
         """
-        Returns the next line from the file
+        Find where every sequence is in the file and determine the flanking regions from the reference genome. 
+        Sequences are only copied out of the file when they are cleaned (see process_aligned_seq). 
         
-        return: logical, True if line is read, False when end of file 
+        param mode: string, name of reference genome (used to determine flanking regions)
         """
-        line = self.file.readline().strip() 
-        if not line: 
-            # no more line, file is finished
-            return False 
+        buf = self.file
+        # find the offset of every header line ('>' at the start of the file or right after a newline)
+        self.header_offsets = [0] if buf[:1] == b'>' else []
+        pos = buf.find(b'\n>')
+        while pos != -1:
+            self.header_offsets.append(pos+1)
+            pos = buf.find(b'\n>', pos+1)
+        self.header_offsets.append(len(buf))  # end of the last sequence 
         
-        self.line = line 
-        return True  #return True when there is still line to be read 
+        self.process_ref_genome(ref_name)
     
-    def obtain_reference(self, ref_name):
+    def records(self):
         """
-        Obtain the reference genome from the MSA file
+        Go through the sequences in the file one at a time 
         
-        param mode: string, name of reference genome.
+        return: generator of (bytes, int, int), sequence name/description and start/end offsets of its sequence
         """
-        basename = os.path.basename(self.filename)
-        self.ref_filename = "reference_genome_" + basename  # name of the new reference genome file 
-        bash_command = "grep -A1 '" + ref_name + "' " + self.filename + " > " + self.ref_filename
-        os.system(bash_command)  # obtain the reference genome
-        
+        buf = self.file
+        for start, end in zip(self.header_offsets, self.header_offsets[1:]):
+            header_end = buf.find(b'\n', start, end)  # the sequence starts after the header line 
+            if header_end == -1:
+                header_end = end
+            yield buf[start:header_end].strip(), header_end, end
     
-    def read_file(self, seq_type, flank_ranges=''): 
+    def get_seq(self, start, end):
         """
-        Process the sequence data by determining flanking regions from the reference genome, and using those ranges to
-        clean aligned sequences. 
-        
-        param mode: string, type of sequence, either 'reference_genome' (used to determine flanking regions)
-        or 'aligned_sequences' (sequences to be edited). 
-        """
-        while self.next_line():  # iterate through every lines in the file
-            if self.line.startswith('>'):  # create new dictonary key using sequence name/description 
-                self.seqdict[self.line] = ''  # set value of dictionary key to be empty 
-            else:
-                last_key = list(self.seqdict.keys())[-1]  # access the last key created in the dictionary
-                self.seqdict[last_key] += self.line  # append line (sequence) to the value of key 
-        
-        if seq_type == 'reference_genome':
-            self.process_ref_genome()
+        Copy a sequence out of the file
         
-        if seq_type == 'aligned_sequences':
-            self.process_aligned_seq(flank_ranges)
+        param mode: int, start and end offsets of the sequence (from records())
+        return: bytes, the sequence with line breaks removed 
+        """
+        return self.file[start:end].translate(None, b' \t\r\n')
     
-    def process_ref_genome(self):
+    def process_ref_genome(self, ref_name):
         """
         Create ranges of flanking regions based on the reference genome. The resulting ranges (coordinates) will then 
         determine the regions in other sequences to be cleaned. 
+        
+        param mode: string, name of reference genome.
         """
-        ref_seq_num = len(self.seqdict.keys())
+        ref_name = ref_name.encode()  # sequence names are bytes 
+        # sequences whose name matches the reference genome
+        ref_records = [record for record in self.records() if ref_name in record[0]]
+        ref_seq_num = len(ref_records)
         if ref_seq_num > 1:
             raise Exception("Argument for name of reference genome is not unique enough, resulting in multiple genomes being used. Please try another argument that is more specific.")
             
         if ref_seq_num == 0:
             raise Exception("Could not find the specified reference genome. Please check to make sure the argument matches name of reference genome.") 
         
-        seq = list(self.seqdict.items())[0][1]  # access the reference genome sequence
-        self.flank_range_list=[]  # list of dictionaries of flank ranges [{'id' : 1, 'start' : 20, 'end' : 25, 'total' : 6}]
-        pos = 0  # keep track of position of characters in sequence string (first letter is 0)
-        prev_char = False  # keep track of the previous character (true if '-', false if not '-')
-        range_num = 1  # keep track of number of ranges 
-        # iterate through each character in the reference sequence - keep count of character's position
-        for char in seq:
-            # check to see if character is '-'
-            if char == '-':
-                current_char = True  # set the current character = '-'
-                if prev_char == False:  # if previous character isn't '-', then start a new range 
-                    self.flank_range_list.append({'id' : range_num, 'start' : pos})
-                    range_num+=1  
-
-            else:  # if not '-'
-                current_char = False  # set the current character as not '-'
-                if prev_char == True:  # if previous character was '-', then prev position was the end 
-                    temp_dict = self.flank_range_list[-1]
-                    temp_dict['end'] = pos-1  # record the end of the range 
-                    temp_dict['total'] = temp_dict['end'] - temp_dict['start'] + 1
-                    
-            pos+=1  # increase character position counter 
-            prev_char = current_char  # set condition for previous character 
+        seq = self.get_seq(ref_records[0][1], ref_records[0][2])  # access the reference genome sequence
+        # flank ranges are kept as two parallel arrays of coordinates, ex: starts[0] = 20, ends[0] = 25 
+        # each run of '-' in the reference genome is one range
+        self.flank_starts = array('i')  # position of first '-' of each range (first letter is 0)
+        self.flank_ends = array('i')  # position of last '-' of each range 
+        for match in GAP_PATTERN.finditer(seq):
+            self.flank_starts.append(match.start())
+            self.flank_ends.append(match.end()-1)
     
-    def process_aligned_seq(self, flank_ranges):
+    def process_aligned_seq(self, flank_starts, flank_ends, threads=1):
         """
         The rest of the alignment is cleaned using the ranges/coordinates from the reference genome. 
+        Sequences are read, cleaned and handed back one at a time in file order, so only a few are in memory at once. 
+        Each sequence is cleaned independently, so they can be split between several processes. 
         
-        param mode: list of dictionaries of flanking regions/ranges (from the reference genome)
-        """
-        for key, value in self.seqdict.items():
-            for each_range in flank_ranges:
-                start = each_range['start']
-                end = each_range['end'] 
-                total = each_range['total']
-                add = '-'*total
-                self.seqdict[key] = value[:start]+add+value[end+1:]
-                value = self.seqdict[key]
+        param mode: arrays of start and end positions of flanking regions/ranges (from the reference genome); 
+        int, number of processes to use
+        return: generator of (bytes, bytearray), sequence name/description and cleaned sequence
+        """
+        flank_ranges = list(zip(flank_starts.tolist(), flank_ends.tolist()))  # unpacked once, reused for every sequence
+        sequences = ((key, self.get_seq(start, end)) for key, start, end in self.records())
+        if threads > 1:
+            with Pool(threads, initializer=_init_worker, initargs=(flank_ranges,)) as pool:
+                # Pool.imap reads its whole input right away, so only hand it a limited batch of sequences at a time 
+                while True:
+                    batch = list(islice(sequences, threads*POOL_CHUNKSIZE*4))
+                    if not batch:
+                        break
+                    keys = [key for key, value in batch]
+                    values = [value for key, value in batch]
+                    del batch
+                    yield from zip(keys, pool.imap(_clean_one, values, chunksize=POOL_CHUNKSIZE))
+        else:
+            cleaner = make_cleaner(flank_ranges)
+            for key, value in sequences:
+                yield key, clean_seq(value, cleaner)
                 
-    def save_output(self, output_name):
+    def save_output(self, output_name, width=80, threads=1):
         """
-        Save the cleaned loci result
+        Clean the sequences and save the cleaned loci result. Each sequence is written as soon as it is cleaned. 
         
-        param mode: logical, False if user did not specify name for output
+        param mode: logical, False if user did not specify name for output; 
+        int, number of characters per sequence line (0 = whole sequence on one line); 
+        int, number of processes used to clean the sequences
         """
-        print("Cleaning completed, saving result")
+        print("Cleaning sequences and saving result")
         if not output_name:  # user did not specify name for output 
             basename = os.path.basename(self.filename)
             output_name = 'cleaned_loci_'+basename  # name for output file 
         
-        with open(output_name, 'w') as f:
-            for key, value in self.seqdict.items():
-                f.write(key)
-                f.write('\n')
-                f.write(value)
-                f.write('\n')
-                
-        os.system("rm " + self.ref_filename)  # delete reference genome file 
+        cleaned = self.process_aligned_seq(self.flank_starts, self.flank_ends, threads)
+        # the input is still being read while the output is written, so write to a temporary file next to the output 
+        # and only move it into place once every sequence is saved (this also allows overwriting the input file)
+        output_dir = os.path.dirname(os.path.abspath(output_name))
+        fd, temp_name = tempfile.mkstemp(dir=output_dir, prefix='.cleaned_loci_', suffix='.tmp')
+        try:
+            umask = os.umask(0)  # mkstemp only gives the owner access, use the usual permissions of a new file 
+            os.umask(umask)
+            os.chmod(temp_name, 0o666 & ~umask)
+            with os.fdopen(fd, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                f.writelines(key + b'\n' + wrap_seq(value, width) + b'\n' for key, value in cleaned)
+            os.replace(temp_name, output_name)
+        except BaseException:
+            os.remove(temp_name)  # don't leave a partial output behind 
+            raise
         
         print("Resulting file named '" + output_name + "' saved - program is finished.")
 
 if __name__ == '__main__':
+    # COMMAND LINE ARGUMENTS:
+    parser = argparse.ArgumentParser()
+    # required parameters/inputs:
+    parser.add_argument("file", help="path to fasta file containing the multiple sequence alignment to be cleaned.")
+    parser.add_argument("ref", help="name of the reference genome in the MSA fasta file (does not have to be the whole name, just needs to be unique enough). Other sequences will be trimmed based on the gap of this sequence. ex: 'BMORI'")
+    # optional parameters/inputs:
+    parser.add_argument("--out", help="path/name of file output. False = output would be in current directory.") 
+    parser.add_argument("--width", type=int, default=80, help="number of characters per sequence line in the output. 0 = each sequence on a single line. Default = 80.")
+    parser.add_argument("--threads", type=int, default=1, help="number of processes used to clean the sequences. Default = 1.")
+    args = parser.parse_args()
+    if args.width < 0:
+        parser.error("--width must be 0 or more")
+    if args.threads < 1:
+        parser.error("--threads must be 1 or more")
+    
     print("Processing <" + args.file + "> using <" + args.ref + "> as the reference genome.")
     MSA = Sequence(args.file)  # create object and opens the file
-    MSA.obtain_reference(str(args.ref))  # obtain the reference genome from the file
-    ref = Sequence(MSA.ref_filename)  # create object and open file
-    ref.read_file('reference_genome')  # process the reference genome file 
-    MSA.read_file('aligned_sequences', flank_ranges=ref.flank_range_list)  # process the MSA file 
+    MSA.read_file(str(args.ref))  # find the sequences and the reference genome in the MSA file 
     
     # SAVE FILE: 
     output_name = False  # no user specified name
     if args.out:  # user specified output file name 
         output_name=args.out
-    MSA.save_output(output_name)
+    MSA.save_output(output_name, args.width, args.threads)  # clean and save the sequences
                 